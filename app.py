@@ -1,41 +1,960 @@
 import streamlit as st
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, APIConnectionError, APIStatusError, APITimeoutError
 from docx import Document
 from io import BytesIO
-import moviepy.editor as mp
+import subprocess
 import tempfile
-import docx
+import numpy as np
 import pandas as pd
 import fitz
 import base64
-import requests
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import math
+import multiprocessing
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode
 from streamlit_quill import st_quill
-from pptx import Presentation
-from PIL import Image
+from PIL import Image, ImageOps
+from pydub import AudioSegment
+from pydub.silence import detect_silence
+from pydub.utils import mediainfo_json
+import tiktoken
+import extractors
+from extractors import EXCEL_MAX_ROWS, EXCEL_MODES
 
-api_key = st.secrets["OPENAI_API_KEY"]
+# Read the API key from Streamlit secrets, or from the environment when running headless
+try:
+    api_key = st.secrets["OPENAI_API_KEY"]
+except (FileNotFoundError, KeyError):
+    api_key = os.getenv("OPENAI_API_KEY")
+
+# Estimated USD prices per million input and output tokens, matched by model name prefix
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+# Prompt tokens served from the provider's prompt cache are billed at a discount
+CACHED_TOKEN_DISCOUNT = 0.5
+WHISPER_PRICE_PER_MINUTE = 0.006
+# Number of recent run traces kept in each session
+MAX_TRACES_PER_SESSION = 10
+
+# Spans recorded for one run (processing files or generating), shared by the threads it uses
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def to_json(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        return {"trace_id": self.trace_id, "name": self.name, "spans": spans}
+
+    # OTLP/JSON layout, so traces can be loaded by OpenTelemetry tooling
+    def to_otlp(self):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        spans = []
+        for span in self.to_json()["spans"]:
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": span["span_id"],
+                "parentSpanId": span["parent_id"] or "",
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(int(span["start"] * 1e9)),
+                "endTimeUnixNano": str(int((span["start"] + span["duration"]) * 1e9)),
+                "attributes": [attribute(key, value) for key, value in span["attributes"].items() if value is not None],
+                "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+            })
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [attribute("service.name", "wonk")]},
+                "scopeSpans": [{"scope": {"name": "wonk"}, "spans": spans}],
+            }]
+        }
+
+    # Per-stage totals, one row per span name
+    def summary(self):
+        rows = [{"stage": span["name"], "seconds": span["duration"], **span["attributes"]} for span in self.to_json()["spans"]]
+        df = pd.DataFrame(rows)
+        columns = {"seconds": ["count", "sum", "max"]}
+        for column in ["bytes_in", "bytes_out", "prompt_tokens", "completion_tokens", "cost_usd"]:
+            if column in df:
+                columns[column] = "sum"
+        summary = df.groupby("stage").agg(columns)
+        summary.columns = ["calls", "total_seconds", "max_seconds"] + list(summary.columns[3:].get_level_values(0))
+        return summary.sort_values("total_seconds", ascending=False)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+# (span id, attributes) of the innermost open span
+current_span = contextvars.ContextVar("current_span", default=(None, {}))
+
+# Function to add a finished span to the current trace
+def record_span(name, start, duration, attributes, error=None, span_id=None, parent_id=None):
+    trace = current_trace.get()
+    if trace is None:
+        return
+    trace.add({
+        "name": name,
+        "span_id": span_id or uuid.uuid4().hex[:16],
+        "parent_id": parent_id if parent_id is not None else current_span.get()[0],
+        "start": start,
+        "duration": duration,
+        "attributes": attributes,
+        "error": str(error) if error else None,
+    })
+
+# Function to time a block of work as a span; yields its attributes dict for the block to fill in
+@contextlib.contextmanager
+def trace_span(name, **attributes):
+    span_id = uuid.uuid4().hex[:16]
+    parent_id = current_span.get()[0]
+    token = current_span.set((span_id, attributes))
+    start = time.time()
+    timer = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        current_span.reset(token)
+        record_span(name, start, time.perf_counter() - timer, attributes, error, span_id, parent_id)
+
+# Function to add attributes to the innermost open span
+def annotate_span(**attributes):
+    current_span.get()[1].update(attributes)
+
+# Function to start a trace for a run; work done in this context, and work submitted with submit_traced, records into it
+@contextlib.contextmanager
+def start_trace(name):
+    trace = Trace(name)
+    token = current_trace.set(trace)
+    try:
+        with trace_span(name):
+            yield trace
+    finally:
+        current_trace.reset(token)
+
+# Function to submit work to a thread pool so its spans land in the caller's trace
+def submit_traced(executor, function, *args):
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+# Function to measure the size in bytes of a file, buffer or string
+def payload_size(value):
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if hasattr(value, "getbuffer"):
+        return value.getbuffer().nbytes
+    return None
+
+# Decorator that records each call of an extractor as a span with its input and output sizes
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(file, *args, **kwargs):
+        with trace_span(function.__name__, bytes_in=payload_size(file)) as span:
+            result = function(file, *args, **kwargs)
+            span["bytes_out"] = payload_size(result)
+            return result
+    return wrapper
+
+# Function to estimate the USD cost of a completion from its token usage
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            input_price, output_price = MODEL_PRICES[name]
+            billed_prompt_tokens = prompt_tokens - cached_tokens + cached_tokens * CACHED_TOKEN_DISCOUNT
+            return (billed_prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+    return None
+
+# Function to turn a completion's or embedding's usage block into span attributes
+def usage_attributes(model, usage):
+    cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        "cost_usd": estimate_cost(model, usage.prompt_tokens, completion_tokens, cached_tokens),
+    }
+
+# Requests-per-minute and tokens-per-minute budgets per model; None disables the token budget.
+# Accounts on other tiers override them with an OPENAI_RATE_LIMITS table in Streamlit secrets,
+# or a JSON object in the environment, e.g. {"default": [5000, 800000]}. The budgets are also
+# corrected from the x-ratelimit-limit-* headers the server sends with a rate-limited response.
+OPENAI_RATE_LIMITS = {
+    "default": (500, 450_000),
+    "whisper-1": (500, None),
+}
+try:
+    OPENAI_RATE_LIMITS.update(st.secrets["OPENAI_RATE_LIMITS"])
+except (FileNotFoundError, KeyError):
+    OPENAI_RATE_LIMITS.update(json.loads(os.getenv("OPENAI_RATE_LIMITS", "{}")))
+OPENAI_MAX_RETRIES = 6
+OPENAI_BACKOFF_BASE_SECONDS = 1
+OPENAI_BACKOFF_MAX_SECONDS = 60
+# Completion tokens assumed when reserving a request's share of the token budget
+COMPLETION_TOKEN_ESTIMATE = 1000
+
+# Token bucket that refills continuously up to its per-minute capacity
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # Requests larger than the whole bucket wait for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def resize(self, per_minute):
+        with self.lock:
+            self.capacity = per_minute
+            self.tokens = min(self.tokens, per_minute)
+            self.rate = per_minute / 60
+
+# Scheduler that keeps one model's calls within its request and token budgets
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        while True:
+            wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        self.requests.acquire()
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+
+    def pause(self, seconds):
+        # A 429 applies to the whole account, so every caller backs off together
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_limits(self, headers):
+        # The server reports the account's actual budgets, which replace the configured ones
+        requests = headers.get("x-ratelimit-limit-requests", "")
+        tokens = headers.get("x-ratelimit-limit-tokens", "")
+        if requests.isdigit() and int(requests) != self.requests.capacity:
+            self.requests.resize(int(requests))
+        if self.tokens and tokens.isdigit() and int(tokens) != self.tokens.capacity:
+            self.tokens.resize(int(tokens))
+
+# Function to create the OpenAI client shared by every session, with pooled keep-alive connections
+@st.cache_resource
+def get_openai_client():
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(600, connect=10)
+    )
+    # Retries are handled by call_openai so they go through the rate limiter
+    return OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+# Function to get the rate limiter shared by every session for a model. It's first called from
+# worker threads, which have no script context to draw a spinner in.
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(model):
+    return RateLimiter(*OPENAI_RATE_LIMITS.get(model, OPENAI_RATE_LIMITS["default"]))
+
+# Function to read how long the server asked us to wait from a failed response
+def get_retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    if "retry-after-ms" in response.headers:
+        return float(response.headers["retry-after-ms"]) / 1000
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+# Function to decide whether a failed call is worth retrying. An explicit x-should-retry header
+# wins; otherwise connection errors, 429s and server errors are retried, except a 429 for an
+# exhausted quota, which won't clear by waiting.
+def is_retryable(error):
+    if not isinstance(error, APIStatusError):
+        return True
+    should_retry = error.response.headers.get("x-should-retry")
+    if should_retry in ("true", "false"):
+        return should_retry == "true"
+    if error.code == "insufficient_quota":
+        return False
+    return error.status_code == 429 or error.status_code >= 500
+
+# Function to make an OpenAI call within the model's rate limits, retrying 429s and
+# server errors with jittered exponential backoff and honoring Retry-After
+def call_openai(request, model, estimated_tokens=0):
+    limiter = get_rate_limiter(model)
+    with trace_span("openai_request", model=model, attempts=0, rate_limit_wait_seconds=0.0) as span:
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            wait_start = time.perf_counter()
+            limiter.acquire(estimated_tokens)
+            span["rate_limit_wait_seconds"] += time.perf_counter() - wait_start
+            span["attempts"] = attempt + 1
+            try:
+                response = request()
+            except (APIConnectionError, APITimeoutError, APIStatusError) as e:
+                if not is_retryable(e) or attempt == OPENAI_MAX_RETRIES:
+                    raise
+                delay = random.uniform(0, min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+                retry_after = get_retry_after(e)
+                if retry_after is not None:
+                    delay = retry_after + random.uniform(0, OPENAI_BACKOFF_BASE_SECONDS)
+                if isinstance(e, APIStatusError) and e.status_code == 429:
+                    limiter.update_limits(e.response.headers)
+                    limiter.pause(delay)
+                time.sleep(delay)
+                continue
+
+            # Streamed responses report usage at the end, in stream_response
+            usage = getattr(response, "usage", None)
+            if usage is not None and hasattr(usage, "prompt_tokens"):
+                span.update(usage_attributes(model, usage))
+            return response
 
 # Initialize OpenAI client
-client = OpenAI(api_key=api_key)
+client = get_openai_client()
 
-# Function to transcribe audio using Whisper
-def transcribe_audio(audio_file):
-    transcription = client.audio.transcriptions.create(model="whisper-1", file=audio_file)
+# Default number of GPT tasks allowed to run at the same time
+MAX_CONCURRENT_TASKS = 4
+
+# Transcripts over MAX_INPUT_TOKENS are handled map-reduce style: the prompt runs over
+# overlapping chunks in parallel, then a reduce pass merges the partial results
+MAX_INPUT_TOKENS = 100_000
+CHUNK_TOKENS = 12_000
+CHUNK_OVERLAP_TOKENS = 400
+REDUCE_PROMPT = (
+    "The text below contains partial results, produced by applying the following "
+    "instructions to consecutive, slightly overlapping parts of a longer text:\n\n{prompt}\n\n"
+    "Merge the partial results into a single result that follows the same instructions. "
+    "Remove duplicates introduced by the overlap and keep the format the instructions ask for."
+)
+
+# Drafts for a single action item only see the passages of the transcription that mention it:
+# the transcription is cut into windows of EXCERPT_PASSAGE_TOKENS, scored by the action item's
+# keywords, and the best windows are kept, in their original order, up to DRAFT_EXCERPT_TOKENS
+DRAFT_EXCERPT_TOKENS = 3000
+EXCERPT_PASSAGE_TOKENS = 300
+EXCERPT_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "into", "about", "will", "should",
+    "have", "has", "are", "was", "were", "been", "our", "their", "they", "them", "you", "your",
+    "all", "any", "who", "what", "when", "where", "which", "how", "its", "not", "but", "can"
+}
+
+# Retrieval mode sends each task only the RETRIEVAL_TOP_K transcription chunks closest to its
+# prompt. A transcription's chunk embeddings are cached on disk as one index entry, and a new
+# index reuses the vectors of the session's previous one, so adding files or editing the
+# transcription only embeds the chunks that changed. Bump RETRIEVAL_INDEX_VERSION whenever
+# chunking changes. Query embeddings are kept in memory.
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256
+RETRIEVAL_CHUNK_TOKENS = 400
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_INDEX_VERSION = 2
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+
+# Every request opens with the same system message and the transcription, and the task
+# prompt comes last, so tasks over one transcription share a prefix the provider can cache
+TRANSCRIPTION_SYSTEM_PROMPT = "You will be given a text, followed by instructions describing what to do with it."
+
+# Long recordings are split into overlapping segments, cut on silence where possible,
+# and transcribed in parallel. Whisper rejects single uploads over 25 MB.
+WHISPER_MAX_BYTES = 25 * 1024 ** 2
+AUDIO_SEGMENT_MS = 10 * 60 * 1000
+AUDIO_SEGMENT_OVERLAP_MS = 3 * 1000
+AUDIO_SILENCE_SEARCH_MS = 30 * 1000
+AUDIO_SEGMENT_MAX_KBPS = 64
+MAX_CONCURRENT_TRANSCRIPTIONS = 4
+
+# ffmpeg output options: drop the video and encode the first audio stream as
+# low-bitrate 16 kHz mono mp3, which is all speech recognition needs
+FFMPEG_AUDIO_ARGS = ["-map", "0:a:0", "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "32k", "-f", "mp3", "pipe:1"]
+
+# Files are ingested concurrently: network-bound extractors share a thread pool and
+# CPU-heavy document parsers (in extractors.py) run on one long-lived process pool shared
+# by every session. Workers come from a forkserver, or are spawned where that's unavailable,
+# so they never inherit the server's threads, locks or trace context.
+MAX_CONCURRENT_EXTRACTIONS = 8
+MAX_PROCESS_WORKERS = min(os.cpu_count() or 1, MAX_CONCURRENT_EXTRACTIONS)
+PROCESS_POOL_CONTEXT = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Images are downscaled to the resolution the vision model actually uses (high detail fits
+# the image in 2048x2048, then scales the short side down to 768) and recompressed
+VISION_MODEL = "gpt-4o-mini"  # Assuming "gpt-4o-mini" is the model with vision capabilities
+IMAGE_PROMPT = "What’s in this image?"
+IMAGE_MAX_LONG_SIDE = 2048
+IMAGE_MAX_SHORT_SIDE = 768
+IMAGE_JPEG_QUALITY = 85
+IMAGE_MAX_TOKENS = 300
+# Number of images sent together when batching vision requests
+IMAGE_BATCH_SIZE = 4
+
+# PDF pages are parsed on the process pool: one task for small documents, and documents with at
+# least PDF_PARALLEL_MIN_PAGES selected pages split across workers. Pages without text are
+# skipped, or rendered and read through the vision model when OCR is on. With OCR, pages are
+# parsed PDF_OCR_CHUNK_PAGES at a time and at most PDF_MAX_PENDING_OCR_PAGES rendered pages
+# wait for the vision model, so memory doesn't grow with the document.
+PDF_PARALLEL_MIN_PAGES = 64
+PDF_OCR_CHUNK_PAGES = 4
+PDF_MAX_PENDING_OCR_PAGES = 8
+PDF_OCR_PROMPT = "Transcribe all of the text on this page. Describe any charts or diagrams briefly."
+PDF_OCR_MAX_TOKENS = 1500
+
+# Disk cache shared by every session on this server, bounded per namespace
+CACHE_DIR = os.getenv("WONK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wonk_cache"))
+CACHE_MAX_BYTES = {
+    "content": 2 * 1024 ** 3,
+    "responses": 256 * 1024 ** 2,
+    "embeddings": 512 * 1024 ** 2,
+}
+
+# Bump an extractor's version whenever its output changes so stale cache entries are ignored
+EXTRACTOR_VERSIONS = {
+    "transcribe_video": 3,
+    "transcribe_audio": 2,
+    "read_docx": 1,
+    "read_txt": 1,
+    "read_excel": 3,
+    "read_pdf": 2,
+    "read_pptx": 1,
+    "transcribe_image": 2,
+}
+
+# Function to read an entry from the disk cache, marking it as recently used
+def read_cache(namespace, key):
+    path = os.path.join(CACHE_DIR, namespace, key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return data
+
+# Writes keep a running size per cache namespace and only scan the directory when it's over
+# budget. The first write in a process scans to seed it; writes from other processes are picked
+# up then and at each eviction. Eviction trims down to CACHE_EVICT_FRACTION of the budget so the
+# next scans are many writes away.
+CACHE_EVICT_FRACTION = 0.9
+
+# Function to get the running cache sizes and their lock, shared by every session and rerun
+@st.cache_resource(show_spinner=False)
+def get_cache_sizes():
+    return {}, threading.Lock()
+
+# Function to write an entry to the disk cache and evict the least recently used entries
+def write_cache(namespace, key, data):
+    directory = os.path.join(CACHE_DIR, namespace)
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temp file first so concurrent readers never see a partial entry
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".tmp-", delete=False) as f:
+        f.write(data)
+    os.replace(f.name, os.path.join(directory, key))
+    cache_sizes, lock = get_cache_sizes()
+    with lock:
+        if namespace in cache_sizes:
+            cache_sizes[namespace] += len(data)
+        if cache_sizes.get(namespace, CACHE_MAX_BYTES[namespace] + 1) > CACHE_MAX_BYTES[namespace]:
+            cache_sizes[namespace] = evict_cache(namespace)
+
+# Function to trim a cache namespace below its size limit, oldest entries first, returning its size
+def evict_cache(namespace):
+    directory = os.path.join(CACHE_DIR, namespace)
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.startswith(".tmp-"):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    if total_size > CACHE_MAX_BYTES[namespace]:
+        for _, size, path in sorted(entries):
+            if total_size <= CACHE_MAX_BYTES[namespace] * CACHE_EVICT_FRACTION:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+    return total_size
+
+# Function to build the cache key for a file's content and the extractor that handles it.
+# Answers from batched vision requests are worded differently from single-image ones, so
+# batch_images keys images separately.
+def content_cache_key(digest, extractor_name, options=None, batch_images=False):
+    if batch_images and extractor_name == "transcribe_image":
+        options = {**(options or {}), "batch": True}
+    key = f"{extractor_name}-v{EXTRACTOR_VERSIONS[extractor_name]}-{digest}"
+    if options:
+        key += "-" + hashlib.sha256(json.dumps(options, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return key
+
+# Function to transcribe a single audio file or segment using Whisper
+def transcribe_audio_segment(audio_file):
+    def request():
+        audio_file.seek(0)
+        return client.audio.transcriptions.create(model="whisper-1", file=audio_file)
+
+    transcription = call_openai(request, "whisper-1")
     return transcription['text'] if isinstance(transcription, dict) else transcription.text
 
+# Function to pick segment boundaries, preferring a silence just before each target cut
+def find_segment_boundaries(audio):
+    boundaries = [0]
+    while len(audio) - boundaries[-1] > AUDIO_SEGMENT_MS:
+        target = boundaries[-1] + AUDIO_SEGMENT_MS
+        window_start = target - AUDIO_SILENCE_SEARCH_MS
+        window = audio[window_start:target]
+        if window.dBFS != float("-inf"):
+            silences = detect_silence(window, min_silence_len=500, silence_thresh=window.dBFS - 16, seek_step=10)
+            if silences:
+                start, end = silences[-1]
+                target = window_start + (start + end) // 2
+        boundaries.append(target)
+    boundaries.append(len(audio))
+    return boundaries
+
+# Function to join two transcripts, dropping the words repeated by the segment overlap
+def merge_transcripts(previous, current, max_overlap_words=40, min_overlap_words=3):
+    previous_words = previous.split()
+    current_words = current.split()
+    normalize = lambda word: re.sub(r"\W", "", word.lower())
+    longest = min(max_overlap_words, len(previous_words), len(current_words))
+    for size in range(longest, min_overlap_words - 1, -1):
+        if [normalize(w) for w in previous_words[-size:]] == [normalize(w) for w in current_words[:size]]:
+            return " ".join(previous_words + current_words[size:])
+    return f"{previous} {current}".strip()
+
+# Function to read an audio file's duration (ms) and bitrate (kbps) with ffprobe, without decoding it.
+# Either is None when the container doesn't report it.
+def probe_audio(audio_file):
+    audio_file.seek(0)
+    try:
+        info = mediainfo_json(audio_file)
+    except Exception:
+        return None, None
+    finally:
+        audio_file.seek(0)
+    info_format = info.get("format", {})
+    audio_streams = [stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"]
+    duration = info_format.get("duration") or (audio_streams[0].get("duration") if audio_streams else None)
+    bit_rate = (audio_streams[0].get("bit_rate") if audio_streams else None) or info_format.get("bit_rate")
+    try:
+        duration_ms = float(duration) * 1000 if duration else None
+    except ValueError:
+        duration_ms = None
+    try:
+        bitrate_kbps = int(bit_rate) // 1000 if bit_rate else None
+    except ValueError:
+        bitrate_kbps = None
+    return duration_ms, bitrate_kbps
+
+# Function to transcribe audio using Whisper, splitting long recordings into parallel segments
+@traced
+def transcribe_audio(audio_file):
+    audio_file.seek(0, os.SEEK_END)
+    file_size = audio_file.tell()
+    audio_file.seek(0)
+
+    # Short, small files go to Whisper as uploaded; only recordings that need splitting are decoded
+    duration_ms, bitrate_kbps = probe_audio(audio_file)
+    if duration_ms is not None:
+        annotate_span(audio_seconds=duration_ms / 1000, cost_usd=duration_ms / 60000 * WHISPER_PRICE_PER_MINUTE)
+        if duration_ms <= AUDIO_SEGMENT_MS and file_size <= WHISPER_MAX_BYTES:
+            return transcribe_audio_segment(audio_file)
+
+    # Decode at 16 kHz mono, which is all Whisper uses, to keep long recordings small in memory
+    audio = AudioSegment.from_file(audio_file, parameters=["-ac", "1", "-ar", "16000"])
+    if duration_ms is None:
+        annotate_span(audio_seconds=len(audio) / 1000, cost_usd=len(audio) / 60000 * WHISPER_PRICE_PER_MINUTE)
+    boundaries = find_segment_boundaries(audio)
+    if len(boundaries) == 2 and file_size <= WHISPER_MAX_BYTES:
+        audio_file.seek(0)
+        return transcribe_audio_segment(audio_file)
+
+    # Segments are re-encoded at no more than the source bitrate, so they never grow past the upload
+    bitrate = f"{min(AUDIO_SEGMENT_MAX_KBPS, bitrate_kbps or AUDIO_SEGMENT_MAX_KBPS)}k"
+    segments = []
+    for i in range(len(boundaries) - 1):
+        start = max(0, boundaries[i] - AUDIO_SEGMENT_OVERLAP_MS)
+        segment_file = BytesIO()
+        audio[start:boundaries[i + 1]].export(segment_file, format="mp3", bitrate=bitrate)
+        segment_file.name = f"segment_{i}.mp3"
+        segment_file.seek(0)
+        segments.append(segment_file)
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TRANSCRIPTIONS) as executor:
+        futures = [submit_traced(executor, transcribe_audio_segment, segment) for segment in segments]
+        texts = [future.result() for future in futures]
+
+    transcript = texts[0]
+    for text in texts[1:]:
+        transcript = merge_transcripts(transcript, text)
+    return transcript
+
+# Rough tokenizer used when tiktoken can't download its encoding files, e.g. offline:
+# splits text into 4-character pieces, about the size of an English token
+class ApproximateEncoding:
+    def encode(self, text, disallowed_special=()):
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+# Function to get the tokenizer for a model, falling back to the gpt-4o encoding
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return ApproximateEncoding()
+
+# Function to count the tokens a text uses for a model
+def count_tokens(text, model):
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+# Function to shrink an oversized transcription by running the prompt over overlapping chunks.
+# Returns the text and prompt for the final request: unchanged when the transcription fits,
+# otherwise the combined partial results and a reduce prompt. The chunk requests take slots
+# from the caller's request_slots, so they count against its concurrency limit.
+def map_reduce_input(transcription, model, custom_prompt, request_slots=None):
+    encoding = get_encoding(model)
+    tokens = encoding.encode(transcription, disallowed_special=())
+    if len(tokens) <= MAX_INPUT_TOKENS:
+        return transcription, custom_prompt
+
+    step = CHUNK_TOKENS - CHUNK_OVERLAP_TOKENS
+    chunks = [encoding.decode(tokens[start:start + CHUNK_TOKENS]) for start in range(0, len(tokens) - CHUNK_OVERLAP_TOKENS, step)]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS) as executor:
+        futures = [submit_traced(executor, generate_response, chunk, model, custom_prompt, 0, request_slots) for chunk in chunks]
+        partials = [future.result() for future in futures]
+
+    combined = "\n\n".join(f"Part {i} of {len(partials)}:\n{partial}" for i, partial in enumerate(partials, 1))
+    # Many partial results can still overflow the context, so reduce again if needed
+    return map_reduce_input(combined, model, REDUCE_PROMPT.format(prompt=custom_prompt), request_slots)
+
+# Function to pick the passages of a transcription most relevant to a query, within a token budget
+def relevant_excerpt(transcription, query, model, max_tokens=DRAFT_EXCERPT_TOKENS):
+    encoding = get_encoding(model)
+    tokens = encoding.encode(transcription, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return transcription
+
+    passages = [encoding.decode(tokens[start:start + EXCERPT_PASSAGE_TOKENS]) for start in range(0, len(tokens), EXCERPT_PASSAGE_TOKENS)]
+    passage_words = [Counter(re.findall(r"[a-z0-9']+", passage.lower())) for passage in passages]
+    terms = {word for word in re.findall(r"[a-z0-9']+", query.lower()) if len(word) > 2 and word not in EXCERPT_STOPWORDS}
+    # Rarer terms count for more, so a name or project beats words used throughout the meeting
+    weights = {term: math.log(len(passages) / (1 + sum(term in words for words in passage_words))) + 1 for term in terms}
+    scores = [sum(weights[term] * min(words[term], 3) for term in terms) for words in passage_words]
+
+    # Ties, including no matches at all, fall back to the earliest passages
+    ranked = sorted(range(len(passages)), key=lambda index: (-scores[index], index))
+    selected = sorted(ranked[:max(1, max_tokens // EXCERPT_PASSAGE_TOKENS)])
+    return "\n[...]\n".join(passages[index] for index in selected)
+
+# Function to split a transcription into retrieval chunks of up to RETRIEVAL_CHUNK_TOKENS, made
+# of whole sentences. A chunk may also end early, at a sentence picked by its content hash, so an
+# edit only moves the boundaries near it and the chunks further on keep their embeddings. This
+# holds inside long lines too, like a whole audio transcript on one line.
+def split_retrieval_chunks(transcription, model=EMBEDDING_MODEL):
+    encoding = get_encoding(model)
+    chunks = []
+    current = ""
+    current_tokens = 0
+    for line in transcription.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        for position, sentence in enumerate(re.split(r"(?<=[.!?])\s+", line)):
+            separator = " " if position else "\n"
+            tokens = encoding.encode(sentence, disallowed_special=())
+            # Only a sentence longer than a whole chunk, e.g. unpunctuated text, is cut into windows
+            for start in range(0, len(tokens), RETRIEVAL_CHUNK_TOKENS):
+                piece = tokens[start:start + RETRIEVAL_CHUNK_TOKENS]
+                text = sentence if len(tokens) <= RETRIEVAL_CHUNK_TOKENS else encoding.decode(piece)
+                if current and current_tokens + len(piece) > RETRIEVAL_CHUNK_TOKENS:
+                    chunks.append(current)
+                    current, current_tokens = "", 0
+                current = current + separator + text if current else text
+                current_tokens += len(piece)
+                if current_tokens >= RETRIEVAL_CHUNK_TOKENS // 2 and hashlib.sha256(text.encode("utf-8")).digest()[0] % 4 == 0:
+                    chunks.append(current)
+                    current, current_tokens = "", 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+# Function to embed texts in batches, returning their unit-length vectors as rows of a matrix
+def embed_texts(texts, model=EMBEDDING_MODEL):
+    vectors = [None for _ in texts]
+    with trace_span("embed_texts", model=model, texts=len(texts)):
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            inputs = texts[start:start + EMBEDDING_BATCH_SIZE]
+            response = call_openai(
+                lambda: client.embeddings.create(model=model, input=inputs),
+                model,
+                sum(count_tokens(text, model) for text in inputs)
+            )
+            for item in response.data:
+                vectors[start + item.index] = np.asarray(item.embedding, dtype=np.float32)
+
+    matrix = np.vstack(vectors)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+# Function to get the recently embedded queries (most recently used last) and their lock,
+# shared by every session and rerun
+@st.cache_resource(show_spinner=False)
+def get_query_embeddings():
+    return OrderedDict(), threading.Lock()
+
+# Function to embed retrieval queries, reusing the vectors of recently seen ones
+def embed_queries(queries):
+    query_embeddings, lock = get_query_embeddings()
+    with lock:
+        missing = [query for query in dict.fromkeys(queries) if query not in query_embeddings]
+    if missing:
+        vectors = embed_texts(missing)
+        with lock:
+            query_embeddings.update(zip(missing, vectors))
+    with lock:
+        for query in queries:
+            query_embeddings.move_to_end(query)
+        matrix = np.vstack([query_embeddings[query] for query in queries])
+        while len(query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+            query_embeddings.popitem(last=False)
+    return matrix
+
+# Function to build the disk cache key of a transcription's retrieval index
+def retrieval_index_key(transcription_hash):
+    return hashlib.sha256(json.dumps([EMBEDDING_MODEL, RETRIEVAL_INDEX_VERSION, transcription_hash]).encode("utf-8")).hexdigest()
+
+# Function to read a transcription's cached chunk digests and vectors, or None
+def read_retrieval_index(transcription_hash):
+    cached = read_cache("embeddings", retrieval_index_key(transcription_hash))
+    if cached is None:
+        return None
+    with np.load(BytesIO(cached)) as index:
+        return index["digests"], index["vectors"]
+
+# Function to get a transcription's chunks and their embeddings, shared across reruns and sessions.
+# Chunks whose text also appears in the index of previous_hash reuse its vectors.
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_retrieval_index(transcription_hash, _transcription, _previous_hash=None):
+    chunks = split_retrieval_chunks(_transcription)
+    digests = [hashlib.sha256(chunk.encode("utf-8")).hexdigest() for chunk in chunks]
+    cached = read_retrieval_index(transcription_hash)
+    if cached is not None and cached[0].tolist() == digests:
+        return chunks, cached[1]
+
+    with trace_span("build_retrieval_index", chunks=len(chunks)) as span:
+        previous = read_retrieval_index(_previous_hash) if _previous_hash else None
+        known = dict(zip(previous[0].tolist(), previous[1])) if previous is not None else {}
+        missing = [index for index, digest in enumerate(digests) if digest not in known]
+        span["reused_chunks"] = len(chunks) - len(missing)
+        if missing:
+            known.update(zip([digests[index] for index in missing], embed_texts([chunks[index] for index in missing])))
+        vectors = np.vstack([known[digest] for digest in digests])
+
+        # The whole index is one cache entry, so building it costs a single write
+        buffer = BytesIO()
+        np.savez(buffer, digests=np.array(digests), vectors=vectors)
+        write_cache("embeddings", retrieval_index_key(transcription_hash), buffer.getvalue())
+    return chunks, vectors
+
+# Function to pick the chunks of a transcription most relevant to each query, in transcript order.
+# previous_hash is the hash of the transcription last retrieved from in this session, if any.
+def retrieve_contexts(transcription, queries, top_k=RETRIEVAL_TOP_K, previous_hash=None):
+    if count_tokens(transcription, EMBEDDING_MODEL) <= top_k * RETRIEVAL_CHUNK_TOKENS:
+        return [transcription for _ in queries]
+
+    with trace_span("retrieve_contexts", queries=len(queries), top_k=top_k):
+        chunks, chunk_vectors = get_retrieval_index(transcription_hash(transcription), transcription, previous_hash)
+        scores = embed_queries(queries) @ chunk_vectors.T
+        contexts = []
+        for query_scores in scores:
+            selected = sorted(np.argsort(-query_scores)[:top_k])
+            contexts.append("\n[...]\n".join(chunks[index] for index in selected))
+        return contexts
+
+# Function to build the chat messages for a task, with the transcription as the shared prefix
+def build_messages(transcription, custom_prompt):
+    return [
+        {"role": "system", "content": TRANSCRIPTION_SYSTEM_PROMPT},
+        {"role": "user", "content": transcription},
+        {"role": "user", "content": custom_prompt}
+    ]
+
+# Function to hash a transcription for cache keys
+def transcription_hash(transcription):
+    return hashlib.sha256(transcription.encode("utf-8")).hexdigest()
+
+# Function to build the response cache key for a model, prompt, temperature and transcription
+def response_cache_key(transcription, model, custom_prompt, temperature):
+    key = json.dumps([model, custom_prompt, temperature, transcription_hash(transcription)])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
 # Function to generate response based on prompt and model
-def generate_response(transcription, model, custom_prompt):
-    response = client.chat.completions.create(
-        model=model,
-        temperature=0,
-        messages=[
-            {"role": "system", "content": custom_prompt},
-            {"role": "user", "content": transcription}
-        ]
-    )
-    return response.choices[0].message.content
+# request_slots is an optional semaphore held while the request is in flight; callers that run
+# several tasks at once share one so map-reduce chunks don't multiply their concurrency.
+def generate_response(transcription, model, custom_prompt, temperature=0, request_slots=None):
+    with trace_span("generate_response", model=model, bytes_in=payload_size(transcription)) as span:
+        key = response_cache_key(transcription, model, custom_prompt, temperature)
+        cached = read_cache("responses", key)
+        span["cache_hit"] = cached is not None
+        if cached is not None:
+            return cached.decode("utf-8")
+
+        transcription, custom_prompt = map_reduce_input(transcription, model, custom_prompt, request_slots)
+        with request_slots or contextlib.nullcontext():
+            response = call_openai(
+                lambda: client.chat.completions.create(
+                    model=model,
+                    temperature=temperature,
+                    messages=build_messages(transcription, custom_prompt)
+                ),
+                model,
+                count_tokens(transcription + custom_prompt, model) + COMPLETION_TOKEN_ESTIMATE
+            )
+        content = response.choices[0].message.content
+        span["bytes_out"] = payload_size(content)
+        write_cache("responses", key, content.encode("utf-8"))
+        return content
+
+# Function to stream a response token by token based on prompt and model
+def stream_response(transcription, model, custom_prompt, temperature=0, request_slots=None):
+    # The span is recorded by hand because a context manager can't stay open across yields
+    start = time.time()
+    timer = time.perf_counter()
+    span = {"model": model, "bytes_in": payload_size(transcription)}
+    key = response_cache_key(transcription, model, custom_prompt, temperature)
+    cached = read_cache("responses", key)
+    if cached is not None:
+        span.update(cache_hit=True, bytes_out=len(cached))
+        record_span("stream_response", start, time.perf_counter() - timer, span)
+        yield cached.decode("utf-8")
+        return
+
+    transcription, custom_prompt = map_reduce_input(transcription, model, custom_prompt, request_slots)
+    tokens = []
+    # The slot is held until the stream is fully read
+    with request_slots or contextlib.nullcontext():
+        stream = call_openai(
+            lambda: client.chat.completions.create(
+                model=model,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+                messages=build_messages(transcription, custom_prompt)
+            ),
+            model,
+            count_tokens(transcription + custom_prompt, model) + COMPLETION_TOKEN_ESTIMATE
+        )
+        for chunk in stream:
+            if chunk.usage:
+                span.update(usage_attributes(model, chunk.usage))
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not tokens:
+                    span["first_token_seconds"] = time.perf_counter() - timer
+                tokens.append(chunk.choices[0].delta.content)
+                yield tokens[-1]
+    content = "".join(tokens)
+    span.update(cache_hit=False, bytes_out=payload_size(content))
+    record_span("stream_response", start, time.perf_counter() - timer, span)
+    # Only complete responses are cached
+    write_cache("responses", key, content.encode("utf-8"))
+
+# Function to run GPT tasks concurrently, streaming each one into its own placeholder.
+# A task's optional "context" replaces the transcription for that task. At most max_workers
+# requests are in flight, counting the map-reduce chunks of oversized inputs.
+def generate_responses(transcription, tasks, placeholders, max_workers=MAX_CONCURRENT_TASKS):
+    # Worker threads only push tokens onto the queue; the Streamlit placeholders
+    # are updated from the script thread, which owns the session context.
+    updates = queue.Queue()
+    results = ["" for _ in tasks]
+    errors = {}
+    request_slots = threading.BoundedSemaphore(max_workers)
+
+    def run_task(index, task):
+        try:
+            for token in stream_response(task.get("context", transcription), task["model"], task["prompt"], request_slots=request_slots):
+                updates.put((index, token))
+        except Exception as e:
+            errors[index] = e
+        finally:
+            updates.put((index, None))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, task in enumerate(tasks):
+            submit_traced(executor, run_task, index, task)
+
+        remaining = len(tasks)
+        while remaining:
+            index, token = updates.get()
+            if token is None:
+                remaining -= 1
+                if index in errors:
+                    placeholders[index].error(f"Generation failed: {errors[index]}")
+                continue
+            results[index] += token
+            placeholders[index].markdown(results[index])
+
+    return results, errors
 
 # Function to save meeting minutes as a Word document
 def save_as_docx(minutes):
@@ -50,99 +969,337 @@ def save_as_docx(minutes):
     buffer.seek(0)
     return buffer
 
-# Function to convert video files to .mp3
-def convert_video_to_mp3(uploaded_file, suffix):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_video_file:
-        temp_video_file.write(uploaded_file.getbuffer())
-        temp_video_file_path = temp_video_file.name
+# Function to build the .docx download once per set of generated minutes instead of on every rerun
+@st.cache_data(max_entries=16, show_spinner=False)
+def minutes_docx(minutes):
+    return save_as_docx(minutes).getvalue()
+
+# Function to run ffmpeg on a video input and capture the extracted audio
+def run_ffmpeg_audio_extraction(input_path, data=None):
+    return subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", input_path, *FFMPEG_AUDIO_ARGS],
+        input=data,
+        stdin=None if data is not None else subprocess.DEVNULL,
+        capture_output=True
+    )
 
-    video = mp.VideoFileClip(temp_video_file_path)
+# Function to convert video files to an in-memory .mp3 by piping them through ffmpeg
+@traced
+def convert_video_to_mp3(video_file, suffix):
+    result = run_ffmpeg_audio_extraction("pipe:0", video_file.getbuffer())
 
-    if video.audio is None:
-        st.error(f"The uploaded {suffix} file does not contain an audio track.")
-        return None
+    # Files with the index (moov atom) at the end can't be demuxed from a pipe,
+    # so fall back to a temp file that is always removed afterwards
+    if result.returncode != 0:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_video_file:
+            temp_video_file.write(video_file.getbuffer())
+        try:
+            result = run_ffmpeg_audio_extraction(temp_video_file.name)
+        finally:
+            os.remove(temp_video_file.name)
+
+    if result.returncode != 0:
+        error = result.stderr.decode("utf-8", errors="replace").strip()
+        if "matches no streams" in error:
+            raise ValueError(f"The uploaded {suffix} file does not contain an audio track.")
+        raise RuntimeError(f"ffmpeg could not extract audio from the {suffix} file: {error[-500:]}")
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as audio_file:
-        audio_file_path = audio_file.name
+    audio_file = BytesIO(result.stdout)
+    audio_file.name = "audio.mp3"
+    return audio_file
 
-    video.audio.write_audiofile(audio_file_path)
-    return audio_file_path
+# Function to transcribe the audio track of a video file
+@traced
+def transcribe_video(video_file):
+    suffix = os.path.splitext(video_file.name)[1] or ".mp4"
+    return transcribe_audio(convert_video_to_mp3(video_file, suffix))
 
 # Function to read text from a .docx file
-def read_docx(file):
-    doc = docx.Document(file)
-    return "\n".join([para.text for para in doc.paragraphs])
+read_docx = traced(extractors.read_docx)
 
 # Function to read text from a .txt file
+@traced
 def read_txt(file):
     return file.read().decode("utf-8")
 
-# Function to read text from an Excel file
-def read_excel(file):
-    df = pd.read_excel(file)
-    return df.to_string(index=False)
+# Function to read text from every sheet of an Excel file without loading it into memory
+read_excel = traced(extractors.read_excel)
+
+# Function to turn a page range like "1-20, 25, 40-" into sorted 0-based page numbers
+def parse_page_range(page_range, page_count):
+    page_numbers = set()
+    for part in page_range.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d*)\s*-\s*(\d*)|(\d+)", part)
+        if not match or part == "-":
+            raise ValueError(f"Invalid page range '{part}'. Use page numbers like 1-20, 25, 40-")
+        if match.group(3):
+            first = last = int(match.group(3))
+        else:
+            first = int(match.group(1) or 1)
+            last = int(match.group(2) or page_count)
+        selected = range(max(first, 1) - 1, min(last, page_count))
+        if not selected:
+            raise ValueError(f"Page range '{part}' selects no pages; the document has {page_count} page(s)")
+        page_numbers.update(selected)
+    if not page_numbers:
+        raise ValueError(f"Page range '{page_range}' selects no pages")
+    return sorted(page_numbers)
+
+# Function to yield the selected pages of a PDF in order, extracted on the process pool in
+# contiguous page ranges. At most one range per worker is in flight, and documents split into
+# several ranges are shared with the workers through a temporary file instead of a copy each.
+def iter_pdf_pages(data, page_numbers, ocr=False):
+    if not page_numbers:
+        return
+    if ocr:
+        size = PDF_OCR_CHUNK_PAGES
+    elif len(page_numbers) < PDF_PARALLEL_MIN_PAGES:
+        size = len(page_numbers)
+    else:
+        size = -(-len(page_numbers) // min(MAX_PROCESS_WORKERS, len(page_numbers) // (PDF_PARALLEL_MIN_PAGES // 2)))
+    chunks = [page_numbers[start:start + size] for start in range(0, len(page_numbers), size)]
+
+    with contextlib.ExitStack() as stack:
+        source = data
+        if len(chunks) > 1:
+            pdf_file = stack.enter_context(tempfile.NamedTemporaryFile(suffix=".pdf"))
+            pdf_file.write(data)
+            pdf_file.flush()
+            source = pdf_file.name
+        pending = deque()
+        for chunk in chunks:
+            if len(pending) >= MAX_PROCESS_WORKERS:
+                yield from pending.popleft().result()
+            pending.append(submit_to_process_pool(extractors.extract_pdf_pages, source, chunk, ocr))
+        while pending:
+            yield from pending.popleft().result()
 
-# Function to read text from a PDF file
-def read_pdf(file):
-    document = fitz.open(stream=file.read(), filetype="pdf")
-    text = ""
-    for page_num in range(len(document)):
-        page = document.load_page(page_num)
-        text += page.get_text()
-    return text
+# Function to read the text on a rendered PDF page through the vision model
+def transcribe_pdf_page(png_data):
+    image_url = {"type": "image_url", "image_url": {"url": encode_image(Image.open(BytesIO(png_data)))}}
+    return request_vision([{"type": "text", "text": PDF_OCR_PROMPT}, image_url], PDF_OCR_MAX_TOKENS)
+
+# Function to read text from a PDF file, optionally limited to a page range like "1-20, 25"
+@traced
+def read_pdf(file, pages=None, ocr=False):
+    data = file.read()
+    with fitz.open(stream=data, filetype="pdf") as document:
+        page_count = len(document)
+    page_numbers = parse_page_range(pages, page_count) if pages else list(range(page_count))
+
+    # Rendered pages are OCRed as they arrive, pausing extraction while too many are waiting
+    texts = {}
+    ocr_pages = 0
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TRANSCRIPTIONS) as executor:
+        pending = {}
+        for page_number, text, image in iter_pdf_pages(data, page_numbers, ocr):
+            if text is not None:
+                texts[page_number] = text
+                continue
+            ocr_pages += 1
+            if len(pending) >= PDF_MAX_PENDING_OCR_PAGES:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    texts[pending.pop(future)] = future.result()
+            pending[submit_traced(executor, transcribe_pdf_page, image)] = page_number
+        for future, page_number in pending.items():
+            texts[page_number] = future.result()
+
+    annotate_span(pages=len(page_numbers), ocr_pages=ocr_pages)
+    return "\n".join(texts[page_number] for page_number in sorted(texts))
 
 # Function to read text from a PowerPoint file
-def read_pptx(file):
-    presentation = Presentation(file)
-    text = ""
-    for slide in presentation.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                text += shape.text + "\n"
-    return text
-
-# Function to encode image to base64
+read_pptx = traced(extractors.read_pptx)
+
+# Function to downscale and recompress an image, returning its bytes and MIME type
+def preprocess_image(image):
+    original_format = image.format
+    image = ImageOps.exif_transpose(image)
+    scale = min(1, IMAGE_MAX_LONG_SIDE / max(image.size), IMAGE_MAX_SHORT_SIDE / min(image.size))
+    if scale < 1:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+    buffer = BytesIO()
+    # PNGs are usually screenshots or diagrams, where lossless keeps small text legible
+    if original_format == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue(), "image/png"
+    image.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
+# Function to encode image to a base64 data URL
 def encode_image(image):
-    with BytesIO() as buffer:
-        image.save(buffer, format=image.format)
-        return base64.b64encode(buffer.getvalue()).decode()
+    data, mime_type = preprocess_image(image)
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
+
+# Function to build the message content part for an image file
+def image_content(image_file):
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": encode_image(Image.open(image_file))
+        }
+    }
+
+# Function to send a vision request and return the answer text
+def request_vision(content, max_tokens):
+    response = call_openai(
+        lambda: client.chat.completions.create(
+            model=VISION_MODEL,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=max_tokens
+        ),
+        VISION_MODEL,
+        COMPLETION_TOKEN_ESTIMATE + max_tokens
+    )
+    return response.choices[0].message.content
 
 # Function to transcribe image using GPT-4's multimodal capabilities
+@traced
 def transcribe_image(image_file):
-    image = Image.open(image_file)
-    base64_image = encode_image(image)
+    return request_vision([{"type": "text", "text": IMAGE_PROMPT}, image_content(image_file)], IMAGE_MAX_TOKENS)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"
-    }
+# Function to transcribe several images in one multimodal request, returning one answer per image
+def transcribe_images(image_files):
+    if len(image_files) == 1:
+        return [transcribe_image(image_files[0])]
 
-    payload = {
-        "model": "gpt-4o-mini",  # Assuming "gpt-4o-mini" is the model with vision capabilities
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "What’s in this image?"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ],
-        "max_tokens": 300
-    }
+    prompt = (
+        f"{IMAGE_PROMPT} Answer separately for each of the {len(image_files)} images, in order. "
+        "Start each answer with a line containing only '### Image <number>'."
+    )
+    content = [{"type": "text", "text": prompt}] + [image_content(image_file) for image_file in image_files]
+    answer = request_vision(content, IMAGE_MAX_TOKENS * len(image_files))
+
+    answers = [part.strip() for part in re.split(r"^#+\s*Image\s+\d+\s*:?\s*$", answer, flags=re.MULTILINE)[1:]]
+    if len(answers) != len(image_files):
+        # The model didn't follow the format, so fall back to one request per image
+        return [transcribe_image(image_file) for image_file in image_files]
+    return answers
+
+# Extractors for each supported upload MIME type
+file_extractors = {
+    "video/quicktime": transcribe_video,
+    "video/mp4": transcribe_video,
+    "audio/mpeg": transcribe_audio,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": read_docx,
+    "text/plain": read_txt,
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": read_excel,
+    "application/pdf": read_pdf,
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": read_pptx,
+    "image/jpeg": transcribe_image,
+    "image/png": transcribe_image,
+}
+
+# Document parsers that are CPU-bound and run on the process pool, through extractors.extract_document.
+# read_pdf runs on a thread because it sends its pages to the pool itself and OCRs over the network.
+cpu_bound_extractors = {read_docx, read_excel, read_pptx}
+
+# Function to create the process pool shared by every session. The forkserver imports this
+# script once, as __mp_main__, so main() doesn't run there.
+@st.cache_resource(show_spinner=False)
+def get_process_pool():
+    return ProcessPoolExecutor(max_workers=MAX_PROCESS_WORKERS, mp_context=PROCESS_POOL_CONTEXT)
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    return response.json()['choices'][0]['message']['content']
+# Function to run a function from extractors.py on the shared process pool, replacing the
+# pool if a worker died and broke it
+def submit_to_process_pool(function, *args):
+    try:
+        return get_process_pool().submit(function, *args)
+    except BrokenProcessPool:
+        get_process_pool.clear()
+        return get_process_pool().submit(function, *args)
 
-# Pre-canned prompts and their respective headings
+# Function to extract text from a file's content with the extractor for its MIME type
+def extract_content(file_name, file_type, data, options=None):
+    file = BytesIO(data)
+    file.name = file_name
+    return file_extractors[file_type](file, **(options or {}))
+
+# Function to extract many files at once, reusing cached results for identical bytes.
+# Each file is a (name, MIME type, content, SHA-256 hex digest) tuple. Returns one entry
+# per file in input order: the text, or the exception it raised. With batch_images,
+# images share vision requests in groups of IMAGE_BATCH_SIZE. extractor_options maps an
+# extractor name to keyword arguments for it, e.g. {"read_pdf": {"pages": "1-20"}}.
+# on_update(index, state, error) is called from the calling thread as files progress.
+def extract_files(files, on_update=None, max_workers=MAX_CONCURRENT_EXTRACTIONS, batch_images=False, extractor_options=None):
+    on_update = on_update or (lambda index, state, error=None: None)
+    extractor_options = extractor_options or {}
+    results = [None] * len(files)
+    futures = {}
+    pending_images = []
+    started = {}
+
+    # Each file gets an extract_file span from submission to completion, recorded here because
+    # extractors running in worker processes can't record into this trace themselves
+    def record_file_span(index, error=None, **attributes):
+        file_name, file_type, data, _ = files[index]
+        start, timer = started[index]
+        attributes = {"file_name": file_name, "file_type": file_type, "bytes_in": len(data), **attributes}
+        record_span("extract_file", start, time.perf_counter() - timer, attributes, error)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as thread_pool:
+        try:
+            for index, (file_name, file_type, data, digest) in enumerate(files):
+                started[index] = (time.time(), time.perf_counter())
+                extractor = file_extractors[file_type]
+                options = extractor_options.get(extractor.__name__)
+                key = content_cache_key(digest, extractor.__name__, options, batch_images)
+                cached = read_cache("content", key)
+                if cached is not None:
+                    results[index] = cached.decode("utf-8")
+                    record_file_span(index, cache_hit=True, bytes_out=len(cached))
+                    on_update(index, "cached")
+                    continue
+
+                if batch_images and extractor is transcribe_image:
+                    pending_images.append((index, key, data))
+                    continue
+
+                if extractor in cpu_bound_extractors:
+                    future = submit_to_process_pool(extractors.extract_document, extractor.__name__, file_name, data, options)
+                else:
+                    future = submit_traced(thread_pool, extract_content, file_name, file_type, data, options)
+                futures[future] = [(index, key)]
+                on_update(index, "running")
+
+            for start in range(0, len(pending_images), IMAGE_BATCH_SIZE):
+                batch = pending_images[start:start + IMAGE_BATCH_SIZE]
+                future = submit_traced(thread_pool, transcribe_images, [BytesIO(data) for _, _, data in batch])
+                futures[future] = [(index, key) for index, key, _ in batch]
+                for index, _, _ in batch:
+                    on_update(index, "running")
+
+            for future in as_completed(futures):
+                entries = futures[future]
+                try:
+                    texts = future.result()
+                except Exception as e:
+                    for index, _ in entries:
+                        results[index] = e
+                        record_file_span(index, e, cache_hit=False)
+                        on_update(index, "failed", e)
+                    continue
+                if isinstance(texts, str):
+                    texts = [texts]
+                for (index, key), text in zip(entries, texts):
+                    results[index] = text
+                    write_cache("content", key, text.encode("utf-8"))
+                    record_file_span(index, cache_hit=False, bytes_out=payload_size(text))
+                    on_update(index, "done")
+        finally:
+            # The process pool is shared, so only this run's queued work is dropped
+            for future in futures:
+                future.cancel()
+
+    return results
+
+# Pre-canned prompts and their respective headings. Sections that only need part of the text have
+# a retrieval_query: in retrieval mode they get the chunks closest to it. The rest summarize or
+# assess the whole document, so they always get the full (or map-reduced) transcription.
 pre_canned_prompts = {
     "meeting_summary": {
         "summary": {
@@ -169,7 +1326,8 @@ pre_canned_prompts = {
         },
         "biographical_info": {
             "prompt": "You are a proficient AI with a specialty in distilling biographical information about people. Based on the following text, please identify biographical information about the subject of the research study.",
-            "heading": "Biographical Info"
+            "heading": "Biographical Info",
+            "retrieval_query": "The participant's background: age, location, family, education, job title, role, employer, experience and daily routine"
         },
         "key_insights": {
             "prompt": "You are a proficient AI with a specialty in distilling information into key points. Based on the following user research transcript, please identify the key insights. Identify and list the main points that were discussed or brought up. These should be the most important ideas, findings, or topics that are crucial to the essence of the discussion. Your goal is to provide a list that someone could read to quickly understand what was talked about.",
@@ -177,7 +1335,8 @@ pre_canned_prompts = {
         },
         "recommendations": {
             "prompt": "You are a proficient AI with a specialty in identifying meaningful product opportunities. Based on the transcript, please identify product recommendations/opportunities.",
-            "heading": "Recommendations"
+            "heading": "Recommendations",
+            "retrieval_query": "Problems, frustrations, workarounds, unmet needs, feature requests and suggestions for improving the product"
         }
     },
     "action_items": {
@@ -188,6 +1347,167 @@ pre_canned_prompts = {
     }
 }
 
+# Retrieval queries of the pre-canned sections, by prompt. A task is only narrowed while its prompt
+# is unchanged; once edited it may ask about anything, so it gets the full transcription.
+retrieval_queries = {
+    section["prompt"]: section["retrieval_query"]
+    for sections in pre_canned_prompts.values()
+    for section in sections.values()
+    if "retrieval_query" in section
+}
+
+# Function to keep a finished run's trace in the session, dropping the oldest beyond the limit
+def keep_trace(trace):
+    if "traces" not in st.session_state:
+        st.session_state.traces = []
+    st.session_state.traces = (st.session_state.traces + [trace])[-MAX_TRACES_PER_SESSION:]
+
+# Function to show the latest run's per-stage timings, tokens and cost in the sidebar
+def render_trace_panel():
+    if not st.session_state.get("traces"):
+        return
+    trace = st.session_state.traces[-1]
+    with st.sidebar.expander(f"Last run: {trace.name.replace('_', ' ')}"):
+        spans = trace.to_json()["spans"]
+        run_span = next(span for span in spans if span["parent_id"] is None)
+        cost = sum(span["attributes"].get("cost_usd") or 0 for span in spans)
+        st.caption(f"{run_span['duration']:.1f}s wall time, estimated cost ${cost:.4f}")
+        st.dataframe(trace.summary().drop(index=trace.name))
+        st.download_button(
+            label="Export trace (JSON)",
+            data=json.dumps(trace.to_json(), indent=2),
+            file_name=f"trace-{trace.trace_id}.json",
+            mime="application/json"
+        )
+        st.download_button(
+            label="Export OpenTelemetry spans",
+            data=json.dumps(trace.to_otlp()),
+            file_name=f"trace-{trace.trace_id}.otlp.json",
+            mime="application/json"
+        )
+
+# Draft types offered for each action item, with how the prompt describes them
+DRAFT_KINDS = {
+    "Email": "an email",
+    "Slack": "a Slack message",
+    "Memo": "a memo"
+}
+
+# Function to split generated action items into parent tasks and their indented sub-tasks
+@st.cache_data(max_entries=16, show_spinner=False)
+def parse_action_items(action_items):
+    action_items_dict = {}
+    parent_task = None
+    for item in action_items.split('\n'):
+        if not item:
+            continue
+        if item.startswith("    "):  # Child task
+            if parent_task:
+                action_items_dict[parent_task].append(item.strip())
+        else:  # Parent task
+            parent_task = item.strip()
+            action_items_dict[parent_task] = []
+    return action_items_dict
+
+# Function to build the action items grid data and its AgGrid options
+@st.cache_data(max_entries=16, show_spinner=False)
+def action_items_grid(action_items):
+    grid_data = []
+    for idx, parent in enumerate(parse_action_items(action_items), 1):
+        row = {"Task Number": idx, "Task": parent}
+        row.update({f"Draft {kind}": False for kind in DRAFT_KINDS})
+        grid_data.append(row)
+    grid_df = pd.DataFrame(grid_data)
+
+    gb = GridOptionsBuilder.from_dataframe(grid_df)
+    for kind in DRAFT_KINDS:
+        gb.configure_column(f"Draft {kind}", editable=True, cellEditor="agCheckboxCellEditor")
+    gb.configure_pagination()
+    gb.configure_default_column(editable=True, resizable=True)
+    # The builder nests local defaultdicts, which st.cache_data cannot pickle
+    return grid_df, json.loads(json.dumps(gb.build()))
+
+# Function to show the editable transcription
+@st.fragment
+def render_transcription_panel(transcription):
+    with st.expander("Transcription", expanded=True):
+        st.subheader("Transcription")
+        edited_transcription = st_quill(value=transcription, key='transcription_editor')
+        st.session_state.transcription = edited_transcription
+
+# Function to show the generated minutes and their .docx download
+@st.fragment
+def render_minutes_panel():
+    with st.expander("Generated Minutes", expanded=True):
+        for key, value in st.session_state.generated_minutes.items():
+            st.write(f"**{key}**")
+            st.write(value)
+
+        st.info("Click download to get a docx file of your document!")
+        st.download_button(
+            label="Download Meeting Minutes",
+            data=minutes_docx(st.session_state.generated_minutes),
+            file_name="meeting_minutes.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        )
+
+# Function to show the action items grid and the drafts requested from it
+@st.fragment
+def render_action_items_panel():
+    with st.expander("Action Items", expanded=True):
+        st.subheader("Action Items")
+        st.info("Check boxes to generate documents from tasks!")
+        grid_df, grid_options = action_items_grid(st.session_state.generated_minutes["Action Items"])
+        grid_response = AgGrid(grid_df, gridOptions=grid_options, height=300, fit_columns_on_grid_load=True, update_mode=GridUpdateMode.MODEL_CHANGED)
+
+        # Draft prompts and finished drafts are keyed by (kind, task number), in the order requested
+        draft_prompts = st.session_state.setdefault("draft_prompts", {})
+        drafts = st.session_state.setdefault("drafts", {})
+        if isinstance(grid_response['data'], pd.DataFrame):
+            for index, row in grid_response['data'].iterrows():
+                for kind, description in DRAFT_KINDS.items():
+                    if row[f"Draft {kind}"]:
+                        draft_prompts[(kind, int(row['Task Number']))] = {
+                            "task": row['Task'],
+                            "prompt": f"Draft {description} for the following action item: {row['Task']}"
+                        }
+
+        pending = [key for key in draft_prompts if key not in drafts]
+        generate_all = st.button(f"Generate all checked drafts ({len(pending)})", disabled=not pending)
+
+        to_generate = list(pending) if generate_all else []
+        placeholders = {}
+        for key, draft_prompt in draft_prompts.items():
+            kind, task_num = key
+            st.subheader(f"{kind} Draft for Task {task_num}")
+            st.write(draft_prompt["prompt"])
+            placeholders[key] = st.empty()
+            if key in drafts:
+                placeholders[key].write(drafts[key])
+            elif st.button(f"Generate {kind} for Task {task_num}") and key not in to_generate:
+                to_generate.append(key)
+
+        if to_generate:
+            # Each draft only sends the passages about its action item and sub-tasks
+            sub_tasks = parse_action_items(st.session_state.generated_minutes["Action Items"])
+            queries = [" ".join([draft_prompts[key]["task"]] + sub_tasks.get(draft_prompts[key]["task"], [])) for key in to_generate]
+            with start_trace("draft") as trace:
+                contexts = None
+                if st.session_state.get("retrieval_mode"):
+                    try:
+                        contexts = retrieve_contexts(st.session_state.transcription, queries, previous_hash=st.session_state.get("retrieval_hash"))
+                        st.session_state.retrieval_hash = transcription_hash(st.session_state.transcription)
+                    except Exception as e:
+                        st.warning(f"Retrieval failed, falling back to keyword matching: {e}")
+                if contexts is None:
+                    contexts = [relevant_excerpt(st.session_state.transcription, query, "gpt-4o") for query in queries]
+                tasks = [{"prompt": draft_prompts[key]["prompt"], "model": "gpt-4o", "context": context} for key, context in zip(to_generate, contexts)]
+                results, errors = generate_responses(st.session_state.transcription, tasks, [placeholders[key] for key in to_generate])
+            keep_trace(trace)
+            for index, (key, result) in enumerate(zip(to_generate, results)):
+                if index not in errors:
+                    drafts[key] = result
+
 # Streamlit app
 def main():
     # Custom CSS to set app width and reduce gutter space
@@ -214,33 +1534,86 @@ def main():
 
     st.sidebar.info("Upload mp3, mp4, mov, docx, txt, xlsx, pdf, pptx, or image files to start!")
     uploaded_files = st.sidebar.file_uploader("Upload audio, video, text, or image files", type=["mp3", "mp4", "mov", "docx", "txt", "xlsx", "pdf", "pptx", "jpg", "jpeg", "png"], accept_multiple_files=True)
+    batch_images = st.sidebar.checkbox("Batch images into shared vision requests", help=f"Sends up to {IMAGE_BATCH_SIZE} images per request")
+    pdf_pages = st.sidebar.text_input("PDF pages", placeholder="All pages, or e.g. 1-20, 25")
+    pdf_ocr = st.sidebar.checkbox("Read image-only PDF pages with the vision model")
+    excel_mode = st.sidebar.selectbox("Large spreadsheets", EXCEL_MODES, help="auto samples rows and adds column statistics when a sheet exceeds the row limit")
+    excel_max_rows = st.sidebar.number_input("Spreadsheet rows per sheet", min_value=10, value=EXCEL_MAX_ROWS, step=100)
     process_files = st.sidebar.button("Process Files")
 
     if uploaded_files is not None and process_files:
         if "transcriptions" not in st.session_state:
             st.session_state.transcriptions = []
+        if "processed_files" not in st.session_state:
+            st.session_state.processed_files = set()
 
+        # Only non-default options are passed so default runs share cache entries
+        extractor_options = {}
+        pdf_options = {key: value for key, value in {"pages": pdf_pages.strip(), "ocr": pdf_ocr}.items() if value}
+        if pdf_options:
+            extractor_options["read_pdf"] = pdf_options
+        excel_options = {}
+        if excel_mode != "auto":
+            excel_options["mode"] = excel_mode
+        if int(excel_max_rows) != EXCEL_MAX_ROWS:
+            excel_options["max_rows"] = int(excel_max_rows)
+        if excel_options:
+            extractor_options["read_excel"] = excel_options
+
+        pending_files = []
+        pending_keys = []
         for uploaded_file in uploaded_files:
-            if uploaded_file.type in ["video/quicktime", "video/mp4"]:
-                suffix = ".mov" if uploaded_file.type == "video/quicktime" else ".mp4"
-                audio_file_path = convert_video_to_mp3(uploaded_file, suffix)
-                if audio_file_path is not None:
-                    with open(audio_file_path, "rb") as f:
-                        st.session_state.transcriptions.append(transcribe_audio(f))
-            elif uploaded_file.type == "audio/mpeg":
-                st.session_state.transcriptions.append(transcribe_audio(uploaded_file))
-            elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                st.session_state.transcriptions.append(read_docx(uploaded_file))
-            elif uploaded_file.type == "text/plain":
-                st.session_state.transcriptions.append(read_txt(uploaded_file))
-            elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
-                st.session_state.transcriptions.append(read_excel(uploaded_file))
-            elif uploaded_file.type == "application/pdf":
-                st.session_state.transcriptions.append(read_pdf(uploaded_file))
-            elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.presentationml.presentation":
-                st.session_state.transcriptions.append(read_pptx(uploaded_file))
-            elif uploaded_file.type in ["image/jpeg", "image/png"]:
-                st.session_state.transcriptions.append(transcribe_image(uploaded_file))
+            if uploaded_file.type not in file_extractors:
+                continue
+            data = uploaded_file.getvalue()
+            file_hash = hashlib.sha256(data).hexdigest()
+            # Processing the same file with different options adds it again
+            extractor_name = file_extractors[uploaded_file.type].__name__
+            file_key = content_cache_key(file_hash, extractor_name, extractor_options.get(extractor_name), batch_images)
+            if file_key in st.session_state.processed_files or file_key in pending_keys:
+                continue  # Already part of this session's transcription
+            pending_files.append((uploaded_file.name, uploaded_file.type, data, file_hash))
+            pending_keys.append(file_key)
+
+        if pending_files:
+            with st.status(f"Processing {len(pending_files)} file(s)...", expanded=True) as status:
+                progress_bar = st.progress(0.0)
+                file_placeholders = [st.empty() for _ in pending_files]
+                for placeholder, (file_name, _, _, _) in zip(file_placeholders, pending_files):
+                    placeholder.info(f"{file_name}: queued")
+
+                finished = []
+
+                def on_update(index, state, error=None):
+                    file_name = pending_files[index][0]
+                    if state == "running":
+                        file_placeholders[index].info(f"{file_name}: processing...")
+                        return
+                    if state == "failed":
+                        file_placeholders[index].error(f"{file_name}: {error}")
+                    elif state == "cached":
+                        file_placeholders[index].success(f"{file_name}: loaded from cache")
+                    else:
+                        file_placeholders[index].success(f"{file_name}: done")
+                    finished.append(index)
+                    progress_bar.progress(len(finished) / len(pending_files))
+
+                with start_trace("process_files") as trace:
+                    results = extract_files(pending_files, on_update, batch_images=batch_images, extractor_options=extractor_options)
+                keep_trace(trace)
+
+                failures = 0
+                for file_key, result in zip(pending_keys, results):
+                    if isinstance(result, Exception):
+                        failures += 1
+                        continue
+                    st.session_state.transcriptions.append(result)
+                    st.session_state.processed_files.add(file_key)
+
+                if failures:
+                    status.update(label=f"Processed {len(pending_files) - failures} of {len(pending_files)} file(s), {failures} failed", state="error")
+                else:
+                    status.update(label=f"Processed {len(pending_files)} file(s)", state="complete", expanded=False)
 
         if st.session_state.transcriptions:
             combined_transcription = "\n\n".join(st.session_state.transcriptions)
@@ -248,10 +1621,7 @@ def main():
 
     if "transcription" in st.session_state:
         transcription = st.session_state.transcription
-        with st.expander("Transcription", expanded=True):
-            st.subheader("Transcription")
-            edited_transcription = st_quill(value=transcription, key='transcription_editor')
-            st.session_state.transcription = edited_transcription
+        render_transcription_panel(transcription)
 
         st.sidebar.info("Select what you'd like to create!")
         summary_type = st.sidebar.radio(
@@ -315,6 +1685,12 @@ def main():
                     st.session_state.prompts.pop(i)
                     break
 
+        retrieval_mode = st.sidebar.checkbox(
+            "Retrieval mode",
+            key="retrieval_mode",
+            help=f"Send action item drafts and narrowly scoped sections, like Biographical Info, only the {RETRIEVAL_TOP_K} transcription passages most relevant to them, found with embeddings. Sections about the whole document, like Summary, still get the full transcription."
+        )
+
         if st.session_state.prompts:
             st.info("Click generate to create your document!")
             st.markdown(
@@ -328,111 +1704,52 @@ def main():
                 """,
                 unsafe_allow_html=True
             )
+            max_concurrent_tasks = st.sidebar.slider("Concurrent GPT tasks", min_value=1, max_value=16, value=MAX_CONCURRENT_TASKS)
             if st.button("Generate", key="generate", help=None, on_click=None, disabled=False, use_container_width=False):
-                minutes = {}
-                for i, prompt_info in enumerate(st.session_state.prompts):
-                    task_key = prompt_info["heading"] if prompt_info["heading"] else f"Task {i+1}"
-                    minutes[task_key] = generate_response(st.session_state.transcription, prompt_info["model"], prompt_info["prompt"])
-                st.session_state.generated_minutes = minutes  # Store the generated minutes in session state
+                tasks = list(st.session_state.prompts)
+                task_keys = [prompt_info["heading"] if prompt_info["heading"] else f"Task {i+1}" for i, prompt_info in enumerate(tasks)]
 
-        # Display generated minutes if they exist in session state
-        if 'generated_minutes' in st.session_state:
-            with st.expander("Generated Minutes", expanded=True):
-                for key, value in st.session_state.generated_minutes.items():
-                    st.write(f"**{key}**")
-                    st.write(value)
+                # Stream every task into its own placeholder while they run
+                streaming_area = st.empty()
+                with streaming_area.container():
+                    placeholders = []
+                    for task_key in task_keys:
+                        st.write(f"**{task_key}**")
+                        placeholders.append(st.empty())
 
-                docx_file = save_as_docx(st.session_state.generated_minutes)
+                with start_trace("generate") as trace:
+                    # Only tasks with a focused query are narrowed; the prompts themselves share boilerplate
+                    scoped = [index for index, task in enumerate(tasks) if task["prompt"] in retrieval_queries]
+                    if retrieval_mode and scoped:
+                        try:
+                            contexts = retrieve_contexts(st.session_state.transcription, [retrieval_queries[tasks[index]["prompt"]] for index in scoped], previous_hash=st.session_state.get("retrieval_hash"))
+                            st.session_state.retrieval_hash = transcription_hash(st.session_state.transcription)
+                            for index, context in zip(scoped, contexts):
+                                tasks[index] = dict(tasks[index], context=context)
+                        except Exception as e:
+                            st.warning(f"Retrieval failed, sending the full transcription: {e}")
+                    results, errors = generate_responses(st.session_state.transcription, tasks, placeholders, max_concurrent_tasks)
+                keep_trace(trace)
 
-                st.info("Click download to get a docx file of your document!")
-                st.download_button(
-                    label="Download Meeting Minutes",
-                    data=docx_file,
-                    file_name="meeting_minutes.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                )
+                streaming_area.empty()
+                minutes = {}
+                for index, (task_key, result) in enumerate(zip(task_keys, results)):
+                    if index in errors:
+                        st.error(f"{task_key} failed: {errors[index]}")
+                    else:
+                        minutes[task_key] = result
+                st.session_state.generated_minutes = minutes  # Store the generated minutes in session state
+                # Task numbers refer to the previous action items
+                st.session_state.draft_prompts = {}
+                st.session_state.drafts = {}
 
+        # Each panel is a fragment, so interacting with it reruns only that panel
+        if 'generated_minutes' in st.session_state:
+            render_minutes_panel()
             if "Action Items" in st.session_state.generated_minutes:
-                with st.expander("Action Items", expanded=True):
-                    st.subheader("Action Items")
-                    action_items = st.session_state.generated_minutes["Action Items"]
-                    st.info("Check boxes to generate documents from tasks!")
-                    action_items_list = action_items.split('\n')
-                    action_items_list = [item for item in action_items_list if item]  # Remove empty items
-
-                    action_items_dict = {}
-                    parent_task = None
-
-                    for item in action_items_list:
-                        if item.startswith("    "):  # Child task
-                            if parent_task:
-                                action_items_dict[parent_task].append(item.strip())
-                        else:  # Parent task
-                            parent_task = item.strip()
-                            action_items_dict[parent_task] = []
-
-                    # Prepare data for AgGrid
-                    grid_data = []
-                    for idx, (parent, children) in enumerate(action_items_dict.items(), 1):
-                        grid_data.append({
-                            "Task Number": idx,
-                            "Task": parent,
-                            "Draft Email": False,
-                            "Draft Slack": False,
-                            "Draft Memo": False
-                        })
-
-                    # Convert list of dicts to DataFrame
-                    grid_df = pd.DataFrame(grid_data)
-
-                    # Configure AgGrid
-                    gb = GridOptionsBuilder.from_dataframe(grid_df)
-                    gb.configure_column("Draft Email", editable=True, cellEditor="agCheckboxCellEditor")
-                    gb.configure_column("Draft Slack", editable=True, cellEditor="agCheckboxCellEditor")
-                    gb.configure_column("Draft Memo", editable=True, cellEditor="agCheckboxCellEditor")
-                    gb.configure_pagination()
-                    gb.configure_default_column(editable=True, resizable=True)
-                    grid_options = gb.build()
-
-                    grid_response = AgGrid(grid_df, gridOptions=grid_options, height=300, fit_columns_on_grid_load=True, update_mode=GridUpdateMode.MODEL_CHANGED)
-
-                    # Handling the checkbox responses
-                    if isinstance(grid_response['data'], pd.DataFrame):
-                        for index, row in grid_response['data'].iterrows():
-                            if row["Draft Email"]:
-                                st.session_state[f"email_prompt_{row['Task Number']}"] = f"Draft an email for the following action item: {row['Task']}"
-                                row["Draft Email"] = False
-                            if row["Draft Slack"]:
-                                st.session_state[f"slack_prompt_{row['Task Number']}"] = f"Draft a Slack message for the following action item: {row['Task']}"
-                                row["Draft Slack"] = False
-                            if row["Draft Memo"]:
-                                st.session_state[f"memo_prompt_{row['Task Number']}"] = f"Draft a memo for the following action item: {row['Task']}"
-                                row["Draft Memo"] = False
-
-                    # Display generated drafts
-                    #st.write("### Generate Drafts")
-                    for key in st.session_state.keys():
-                        if key.startswith("email_prompt_"):
-                            task_num = key.split('_')[-1]
-                            st.subheader(f"Email Draft for Task {task_num}")
-                            st.write(st.session_state[key])
-                            if st.button(f"Generate Email for Task {task_num}"):
-                                draft = generate_response(st.session_state.transcription, "gpt-4o", st.session_state[key])
-                                st.write(draft)
-                        elif key.startswith("slack_prompt_"):
-                            task_num = key.split('_')[-1]
-                            st.subheader(f"Slack Draft for Task {task_num}")
-                            st.write(st.session_state[key])
-                            if st.button(f"Generate Slack for Task {task_num}"):
-                                draft = generate_response(st.session_state.transcription, "gpt-4o", st.session_state[key])
-                                st.write(draft)
-                        elif key.startswith("memo_prompt_"):
-                            task_num = key.split('_')[-1]
-                            st.subheader(f"Memo Draft for Task {task_num}")
-                            st.write(st.session_state[key])
-                            if st.button(f"Generate Memo for Task {task_num}"):
-                                draft = generate_response(st.session_state.transcription, "gpt-4o", st.session_state[key])
-                                st.write(draft)
+                render_action_items_panel()
+
+    render_trace_panel()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,157 @@
+import argparse
+import glob
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+# Files read, extracted and summarized together; bounds how many uploads are held in memory
+FILES_PER_ROUND_PER_WORKER = 4
+
+# Function to expand directories and glob patterns into the supported files they contain
+def find_input_files(inputs):
+    paths = []
+    for pattern in inputs:
+        matches = glob.glob(pattern, recursive=True) or [pattern]
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                for root, _, names in os.walk(match):
+                    paths.extend(os.path.join(root, name) for name in sorted(names))
+            elif os.path.isfile(match):
+                paths.append(match)
+
+    supported = []
+    for path in dict.fromkeys(paths):
+        file_type = mimetypes.guess_type(path)[0]
+        if file_type in app.file_extractors:
+            supported.append((path, file_type))
+    return supported
+
+# Function to load the digests of files already summarized from the results file. Only records
+# made with the same config (every setting that changes the output) count, so a rerun with
+# another summary type, section list, model, extraction options or image batching processes the files again.
+def load_checkpoint(results_path, config):
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A partial line left by an interrupted run
+            if "error" not in record and record.get("config") == config:
+                completed.add(record["sha256"])
+    return completed
+
+# Function to run the selected sections over one file's text, returning them keyed by heading
+def summarize(text, sections, model, executor, request_slots):
+    futures = [
+        (section["heading"], executor.submit(app.generate_response, text, model, section["prompt"], request_slots=request_slots))
+        for section in sections
+    ]
+    return {heading: future.result() for heading, future in futures}
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize every recording and document in a directory or glob.")
+    parser.add_argument("inputs", nargs="+", help="Files, directories or glob patterns to process")
+    parser.add_argument("--summary-type", choices=sorted(app.pre_canned_prompts), default="meeting_summary")
+    parser.add_argument("--sections", nargs="+", help="Sections of the summary type to generate (default: all)")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--workers", type=int, default=app.MAX_CONCURRENT_TASKS, help="Files and GPT tasks processed at once")
+    parser.add_argument("--output-dir", default="wonk_output")
+    parser.add_argument("--batch-images", action="store_true", help="Send several images per vision request")
+    parser.add_argument("--pdf-pages", help="Page range to read from each PDF, e.g. 1-20, 25")
+    parser.add_argument("--pdf-ocr", action="store_true", help="Read image-only PDF pages with the vision model")
+    parser.add_argument("--excel-mode", choices=app.EXCEL_MODES, default="auto", help="How sheets over the row limit are condensed")
+    parser.add_argument("--excel-max-rows", type=int, default=app.EXCEL_MAX_ROWS, help="Rows kept per spreadsheet sheet")
+    args = parser.parse_args()
+
+    prompts = app.pre_canned_prompts[args.summary_type]
+    section_keys = args.sections or list(prompts)
+    unknown = [key for key in section_keys if key not in prompts]
+    if unknown:
+        parser.error(f"unknown sections for {args.summary_type}: {', '.join(unknown)} (choose from {', '.join(prompts)})")
+    sections = [prompts[key] for key in section_keys]
+
+    extractor_options = {}
+    pdf_options = {key: value for key, value in {"pages": args.pdf_pages, "ocr": args.pdf_ocr}.items() if value}
+    if pdf_options:
+        extractor_options["read_pdf"] = pdf_options
+    excel_options = {}
+    if args.excel_mode != "auto":
+        excel_options["mode"] = args.excel_mode
+    if args.excel_max_rows != app.EXCEL_MAX_ROWS:
+        excel_options["max_rows"] = args.excel_max_rows
+    if excel_options:
+        extractor_options["read_excel"] = excel_options
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = os.path.join(args.output_dir, "results.jsonl")
+    config = {"summary_type": args.summary_type, "sections": section_keys, "model": args.model, "extractor_options": extractor_options}
+    if args.batch_images:
+        config["batch_images"] = True  # Only set when on, so earlier checkpoints still match
+    config_id = hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+    completed = load_checkpoint(results_path, config)
+
+    input_files = find_input_files(args.inputs)
+    print(f"Found {len(input_files)} supported file(s), {len(completed)} already summarized", file=sys.stderr)
+
+    round_size = max(1, args.workers) * FILES_PER_ROUND_PER_WORKER
+    processed = failed = 0
+    # Files and their GPT tasks use separate pools so a file waiting on its tasks never starves them.
+    # Requests, including map-reduce chunks of long files, share one limit of --workers in flight.
+    request_slots = threading.BoundedSemaphore(max(1, args.workers))
+    with open(results_path, "a", encoding="utf-8") as results_file, \
+            ThreadPoolExecutor(max_workers=args.workers) as file_executor, \
+            ThreadPoolExecutor(max_workers=args.workers) as task_executor:
+        for start in range(0, len(input_files), round_size):
+            files = []
+            for path, file_type in input_files[start:start + round_size]:
+                with open(path, "rb") as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()
+                if digest not in completed:
+                    files.append((path, file_type, data, digest))
+                    completed.add(digest)  # Identical copies later in the run are skipped too
+            if not files:
+                continue
+
+            texts = app.extract_files(files, max_workers=args.workers, batch_images=args.batch_images, extractor_options=extractor_options)
+            summaries = {}
+            for (path, _, _, digest), text in zip(files, texts):
+                if not isinstance(text, Exception):
+                    summaries[digest] = file_executor.submit(summarize, text, sections, args.model, task_executor, request_slots)
+
+            # Records are written in input order and flushed, so an interrupted run resumes after the last one
+            for (path, _, _, digest), text in zip(files, texts):
+                record = {"path": path, "sha256": digest, "summary_type": args.summary_type, "config": config}
+                try:
+                    if isinstance(text, Exception):
+                        raise text
+                    minutes = summaries[digest].result()
+                    stem = os.path.splitext(os.path.basename(path))[0]
+                    # Named per settings too, so runs with other settings don't overwrite each other
+                    docx_path = os.path.join(args.output_dir, f"{stem}-{digest[:8]}-{config_id}.docx")
+                    with open(docx_path, "wb") as f:
+                        f.write(app.save_as_docx(minutes).getvalue())
+                    record.update(sections=minutes, docx=docx_path)
+                    processed += 1
+                    print(f"{path}: done", file=sys.stderr)
+                except Exception as e:
+                    record["error"] = str(e)
+                    failed += 1
+                    print(f"{path}: failed: {e}", file=sys.stderr)
+                results_file.write(json.dumps(record) + "\n")
+                results_file.flush()
+
+    print(f"Summarized {processed} file(s), {failed} failed; results in {results_path}", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+import argparse
+import array
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+# Words the stub server draws its transcripts and completions from
+STUB_WORDS = (
+    "the team agreed to ship the release next week after the review of open issues "
+    "budget roadmap customer feedback follow up owner deadline risk launch metrics"
+).split()
+
+# Dimensions of the stub's embeddings
+STUB_EMBEDDING_DIMENSIONS = 256
+
+# Stand-in for the OpenAI API with configurable latency, rate limiting and error injection
+class StubOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections after a streamed response; that's not a failure
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def __init__(self, latency, jitter, token_delay, requests_per_minute, error_rate, response_words):
+        super().__init__(("127.0.0.1", 0), StubOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.requests_per_minute = requests_per_minute
+        self.error_rate = error_rate
+        self.response_words = response_words
+        self.stats = Counter()
+        self.request_times = []
+        self.lock = threading.Lock()
+
+    # Function to decide whether a request is rate limited, returning the seconds to wait
+    def check_rate_limit(self):
+        if not self.requests_per_minute:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            self.request_times = [t for t in self.request_times if now - t < 60]
+            if len(self.request_times) >= self.requests_per_minute:
+                return 60 - (now - self.request_times[0])
+            self.request_times.append(now)
+        return None
+
+    def text(self, words):
+        return " ".join(random.choice(STUB_WORDS) for _ in range(words))
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.server.lock:
+                self.send_json(200, dict(self.server.stats))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        endpoint = self.path.split("?")[0]
+        with server.lock:
+            server.stats[f"requests {endpoint}"] += 1
+
+        retry_after = server.check_rate_limit()
+        if retry_after is not None:
+            with server.lock:
+                server.stats["429 responses"] += 1
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}}, {"Retry-After": f"{retry_after:.3f}"})
+            return
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.stats["500 responses"] += 1
+            self.send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return
+
+        time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        if endpoint == "/v1/audio/transcriptions":
+            self.send_json(200, {"text": server.text(server.response_words)})
+        elif endpoint == "/v1/chat/completions":
+            self.chat_completion(json.loads(body))
+        elif endpoint == "/v1/embeddings":
+            self.embeddings(json.loads(body))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown endpoint {endpoint}"}})
+
+    def chat_completion(self, request):
+        server = self.server
+        words = server.text(min(server.response_words, request.get("max_tokens") or server.response_words)).split()
+        prompt_tokens = len(json.dumps(request["messages"])) // 4
+        if not request.get("stream"):
+            self.send_json(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, word in enumerate(words):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else f" {word}"}, "finish_reason": None}],
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            time.sleep(server.token_delay)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)},
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    # Hashed bag-of-words vectors, so texts sharing words are closer and retrieval behaves sensibly
+    def embeddings(self, request):
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        data = []
+        for index, text in enumerate(inputs):
+            vector = [0.0] * STUB_EMBEDDING_DIMENSIONS
+            for word in text.lower().split():
+                vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % STUB_EMBEDDING_DIMENSIONS] += 1.0
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(array.array("f", vector).tobytes()).decode("ascii")
+            else:
+                embedding = vector
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        prompt_tokens = sum(len(text) for text in inputs) // 4
+        self.send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": request["model"],
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        })
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+# Function to run the stub server in its own process, reporting its port back to the parent.
+# Keeping it out of the benchmark process means the app's forked workers and timings don't touch it.
+def run_stub_server(ports, *config):
+    server = StubOpenAIServer(*config)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+# Function to build a set of synthetic uploads covering every supported file type
+def build_uploads(count, include_media):
+    import docx
+    import fitz
+    import openpyxl
+    from PIL import Image
+    from pptx import Presentation
+
+    def make_txt():
+        return ("notes.txt", "text/plain", " ".join(random.choices(STUB_WORDS, k=2000)).encode("utf-8"))
+
+    def make_docx():
+        document = docx.Document()
+        for _ in range(100):
+            document.add_paragraph(" ".join(random.choices(STUB_WORDS, k=40)))
+        buffer = BytesIO()
+        document.save(buffer)
+        return ("report.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", buffer.getvalue())
+
+    def make_xlsx():
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["id", "owner", "status", "amount"])
+        for i in range(500):
+            sheet.append([i, random.choice(STUB_WORDS), random.choice(["open", "done"]), random.random() * 1000])
+        buffer = BytesIO()
+        workbook.save(buffer)
+        return ("export.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", buffer.getvalue())
+
+    def make_pdf():
+        document = fitz.open()
+        for _ in range(20):
+            page = document.new_page()
+            page.insert_textbox(fitz.Rect(50, 50, 550, 800), " ".join(random.choices(STUB_WORDS, k=400)))
+        return ("deck.pdf", "application/pdf", document.tobytes())
+
+    def make_pptx():
+        presentation = Presentation()
+        for _ in range(30):
+            slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+            slide.shapes.title.text = " ".join(random.choices(STUB_WORDS, k=5))
+            slide.placeholders[1].text = " ".join(random.choices(STUB_WORDS, k=60))
+        buffer = BytesIO()
+        presentation.save(buffer)
+        return ("slides.pptx", "application/vnd.openxmlformats-officedocument.presentationml.presentation", buffer.getvalue())
+
+    def make_png():
+        image = Image.effect_noise((3000, 2000), 64).convert("RGB")
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        return ("screenshot.png", "image/png", buffer.getvalue())
+
+    def make_mp3():
+        from pydub.generators import Sine
+        buffer = BytesIO()
+        Sine(440).to_audio_segment(duration=60 * 1000).export(buffer, format="mp3")
+        return ("meeting.mp3", "audio/mpeg", buffer.getvalue())
+
+    makers = [make_txt, make_docx, make_xlsx, make_pdf, make_pptx, make_png]
+    if include_media:
+        makers.append(make_mp3)
+
+    uploads = []
+    for i in range(count):
+        name, file_type, data = makers[i % len(makers)]()
+        # Unique bytes per upload so the content cache never short-circuits the run
+        if file_type == "text/plain":
+            data += f" {i}".encode()
+        uploads.append((f"{i:03d}-{name}", file_type, data))
+    return uploads
+
+# Function to read a process's peak resident set size in MB from /proc, or None where that's unavailable.
+# The document parser workers are forked by the forkserver rather than by this process, so
+# getrusage(RUSAGE_CHILDREN) never sees them.
+def peak_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+# Function to summarize a list of latencies in milliseconds
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    if len(latencies) == 1:
+        return {"count": 1, "p50_ms": latencies[0] * 1000, "p95_ms": latencies[0] * 1000}
+    quantiles = statistics.quantiles(latencies, n=20)
+    return {"count": len(latencies), "p50_ms": quantiles[9] * 1000, "p95_ms": quantiles[18] * 1000}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion and Generate pipeline against a local stub OpenAI server.")
+    parser.add_argument("--files", type=int, default=20, help="Mixed uploads to ingest")
+    parser.add_argument("--tasks", type=int, default=8, help="GPT tasks to generate over the combined transcription")
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean stub response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Standard deviation of the stub latency in seconds")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="Delay between streamed tokens in seconds")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute the stub allows before returning 429 (0 disables)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--response-words", type=int, default=300, help="Words in each stub transcript and completion")
+    parser.add_argument("--no-media", action="store_true", help="Skip audio uploads, which need ffmpeg")
+    parser.add_argument("--batch-images", action="store_true")
+    parser.add_argument("--retrieval", action="store_true", help="Send sections with a retrieval query only their top-k transcription chunks, as in the app's retrieval mode")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    ports = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=run_stub_server,
+        args=(ports, args.latency, args.jitter, args.token_delay, args.rpm, args.error_rate, args.response_words),
+        daemon=True
+    )
+    server_process.start()
+    server_url = f"http://127.0.0.1:{ports.get(timeout=30)}"
+
+    # Point the app's OpenAI client at the stub and give it an empty cache before importing it
+    cache_dir = tempfile.TemporaryDirectory(prefix="wonk-bench-")
+    os.environ["OPENAI_BASE_URL"] = f"{server_url}/v1"
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["WONK_CACHE_DIR"] = cache_dir.name
+    import app
+
+    uploads = build_uploads(args.files, not args.no_media)
+    files = [(name, file_type, data, hashlib.sha256(data).hexdigest()) for name, file_type, data in uploads]
+
+    stage_latencies = defaultdict(list)
+
+    # Ingestion: every upload through the same dispatcher the Process Files button uses
+    started = {}
+    ingest_start = time.perf_counter()
+
+    def on_update(index, state, error=None):
+        if state == "running":
+            started[index] = time.perf_counter()
+        elif state in ("done", "failed"):
+            stage = "ingest " + os.path.splitext(files[index][0])[1]
+            stage_latencies[stage].append(time.perf_counter() - started[index])
+
+    with app.start_trace("process_files") as ingest_trace:
+        results = app.extract_files(files, on_update, batch_images=args.batch_images)
+    ingest_seconds = time.perf_counter() - ingest_start
+    failures = [result for result in results if isinstance(result, Exception)]
+    transcription = "\n\n".join(result for result in results if not isinstance(result, Exception))
+
+    # Generate: M streamed tasks at the app's default concurrency, with unique prompts to bypass the response cache.
+    # With --retrieval, embedding the transcription and picking the chunks of sections with a
+    # retrieval query is part of the timed run; the other sections get the full transcription.
+    sections = [section for sections in app.pre_canned_prompts.values() for section in sections.values()]
+
+    task_prompts = [f"{sections[i % len(sections)]['prompt']} (benchmark task {i})" for i in range(args.tasks)]
+    scoped = [i for i in range(args.tasks) if args.retrieval and sections[i % len(sections)].get("retrieval_query")]
+
+    request_slots = threading.BoundedSemaphore(app.MAX_CONCURRENT_TASKS)
+
+    def run_task(i, context):
+        start = time.perf_counter()
+        first_token = None
+        for _ in app.stream_response(context, "gpt-4o", task_prompts[i], request_slots=request_slots):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+        return first_token, time.perf_counter() - start
+
+    generate_start = time.perf_counter()
+    with app.start_trace("generate") as generate_trace, ThreadPoolExecutor(max_workers=app.MAX_CONCURRENT_TASKS) as executor:
+        contexts = [transcription] * args.tasks
+        if scoped:
+            retrieved = app.retrieve_contexts(transcription, [sections[i % len(sections)]["retrieval_query"] for i in scoped])
+            for i, context in zip(scoped, retrieved):
+                contexts[i] = context
+        futures = [app.submit_traced(executor, run_task, i, context) for i, context in enumerate(contexts)]
+        timings = [future.result() for future in futures]
+    generate_seconds = time.perf_counter() - generate_start
+    stage_latencies["generate first token"] = [first for first, _ in timings if first is not None]
+    stage_latencies["generate total"] = [total for _, total in timings]
+
+    # Every span the app recorded below the two runs, e.g. each extractor and OpenAI request
+    usage = Counter()
+    for trace in (ingest_trace, generate_trace):
+        for span in trace.to_json()["spans"]:
+            if span["parent_id"] is not None and span["name"] != "extract_file":
+                stage_latencies[f"span {span['name']}"].append(span["duration"])
+            for field in ("prompt_tokens", "completion_tokens", "cost_usd"):
+                usage[field] += span["attributes"].get(field) or 0
+
+    # The process pool's workers are still alive here, so their peak RSS can be read from /proc
+    worker_rss = [peak_rss_mb(process.pid) for process in multiprocessing.active_children() if process is not server_process]
+    worker_rss = [rss for rss in worker_rss if rss is not None]
+    with urllib.request.urlopen(f"{server_url}/stats") as response:
+        server_stats = json.load(response)
+    server_process.terminate()
+    cache_dir.cleanup()
+
+    # ru_maxrss is in kilobytes on Linux
+    memory = {
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "workers": len(worker_rss),
+        "max_worker_rss_mb": max(worker_rss) if worker_rss else None,
+    }
+
+    report = {
+        "config": vars(args),
+        "ingest": {"files": len(files), "failed": len(failures), "seconds": ingest_seconds, "files_per_second": len(files) / ingest_seconds},
+        "generate": {"tasks": args.tasks, "seconds": generate_seconds, "tasks_per_second": args.tasks / generate_seconds if args.tasks else 0},
+        "stages": {stage: latency_stats(latencies) for stage, latencies in sorted(stage_latencies.items()) if latencies},
+        "usage": dict(usage),
+        "memory": memory,
+        "stub_server": server_stats,
+    }
+
+    print(f"Ingested {len(files)} files in {ingest_seconds:.2f}s ({report['ingest']['files_per_second']:.1f} files/s, {len(failures)} failed)")
+    print(f"Generated {args.tasks} tasks in {generate_seconds:.2f}s ({report['generate']['tasks_per_second']:.1f} tasks/s)")
+    print(f"{'stage':<32}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<32}{stats['count']:>7}{stats['p50_ms']:>10.0f}{stats['p95_ms']:>10.0f}")
+    print(f"Usage: {usage['prompt_tokens']:.0f} prompt + {usage['completion_tokens']:.0f} completion tokens, estimated ${usage['cost_usd']:.4f}")
+    worker_memory = f"{memory['max_worker_rss_mb']:.1f} MB largest of {memory['workers']} parser workers" if worker_rss else "parser workers not measured"
+    print(f"Peak memory: {memory['max_rss_mb']:.1f} MB RSS, {worker_memory}")
+    print("Stub server: " + ", ".join(f"{name}={count}" for name, count in sorted(server_stats.items())))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
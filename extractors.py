@@ -0,0 +1,178 @@
+# CPU-bound document parsers. They run in the app's worker processes, so they live in this
+# importable module rather than in the Streamlit script, which is re-executed on every rerun
+# and so can't be pickled by reference.
+import csv
+import datetime
+import random
+from collections import Counter
+from io import BytesIO, StringIO
+import docx
+import fitz
+import openpyxl
+from pptx import Presentation
+
+# Spreadsheets are streamed sheet by sheet and written as compact CSV. Sheets longer than
+# EXCEL_MAX_ROWS are sampled (or cut) and followed by per-column summary statistics.
+EXCEL_MAX_ROWS = 500
+EXCEL_MAX_COLUMNS = 40
+EXCEL_MAX_CELL_CHARS = 200
+EXCEL_MODES = ["auto", "rows", "sample", "summary"]
+# Distinct values tracked per column for the summary, which bounds its memory
+EXCEL_MAX_DISTINCT_VALUES = 1000
+
+# Resolution PDF pages without text are rendered at for OCR
+PDF_OCR_DPI = 150
+
+# Function to read text from a .docx file
+def read_docx(file):
+    doc = docx.Document(file)
+    return "\n".join([para.text for para in doc.paragraphs])
+
+# Function to format a spreadsheet cell compactly for the model
+def format_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        # 15 significant digits is what Excel itself displays, so amounts come through exactly
+        return format(value, ".15g")
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        return value.date().isoformat()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    text = " ".join(str(value).split())
+    return text if len(text) <= EXCEL_MAX_CELL_CHARS else text[:EXCEL_MAX_CELL_CHARS] + "..."
+
+# Function to describe a column from its running statistics
+def summarize_column(name, stats):
+    parts = [f"{stats['count']} values"]
+    if stats["numeric"]:
+        mean = round(stats["sum"] / stats["numeric"], 6)
+        parts.append(f"numeric min {format_cell(stats['min'])}, max {format_cell(stats['max'])}, mean {format_cell(float(mean))}")
+    if stats["values"]:
+        distinct = f"{len(stats['values'])}+" if len(stats["values"]) >= EXCEL_MAX_DISTINCT_VALUES else str(len(stats["values"]))
+        common = ", ".join(f"{value} ({count})" for value, count in stats["values"].most_common(3))
+        parts.append(f"{distinct} distinct, most common: {common}")
+    return f"{name}: " + "; ".join(parts)
+
+# Function to stream one worksheet into compact CSV. mode is "rows" (first max_rows rows),
+# "sample" (an even random sample of max_rows rows), "summary" (column statistics only)
+# or "auto" (every row if the sheet fits, otherwise a sample plus statistics)
+def read_worksheet(sheet, max_rows, mode):
+    rows = sheet.iter_rows(values_only=True)
+    header = None
+    for row in rows:
+        if any(value is not None for value in row):
+            header = [format_cell(value) for value in row]
+            break
+    if header is None:
+        return None
+
+    stats = [{"count": 0, "numeric": 0, "sum": 0.0, "min": None, "max": None, "values": Counter()} for _ in header]
+    kept = []
+    sampler = random.Random(0)  # Fixed seed so the same file always gives the same text
+    row_count = 0
+    for row in rows:
+        if not any(value is not None for value in row):
+            continue
+        row_count += 1
+        row = row[:len(header)]
+        for column, value in enumerate(row):
+            if value is None or value == "":
+                continue
+            column_stats = stats[column]
+            column_stats["count"] += 1
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                column_stats["numeric"] += 1
+                column_stats["sum"] += value
+                column_stats["min"] = value if column_stats["min"] is None else min(column_stats["min"], value)
+                column_stats["max"] = value if column_stats["max"] is None else max(column_stats["max"], value)
+            else:
+                value = format_cell(value)
+                if len(column_stats["values"]) < EXCEL_MAX_DISTINCT_VALUES or value in column_stats["values"]:
+                    column_stats["values"][value] += 1
+
+        if mode == "summary":
+            continue
+        if len(kept) < max_rows:
+            kept.append((row_count, row))
+        elif mode != "rows":
+            # Reservoir sampling keeps a uniform sample of every row seen so far
+            slot = sampler.randrange(row_count)
+            if slot < max_rows:
+                kept[slot] = (row_count, row)
+
+    # Drop columns that are empty throughout, and cap how many are sent
+    columns = [i for i in range(len(header)) if stats[i]["count"]] or [i for i, name in enumerate(header) if name]
+    dropped_columns = max(0, len(columns) - EXCEL_MAX_COLUMNS)
+    columns = columns[:EXCEL_MAX_COLUMNS]
+    names = [header[i] or f"Column {i + 1}" for i in columns]
+
+    description = f"{row_count} rows x {len(columns)} columns"
+    if dropped_columns:
+        description += f", {dropped_columns} more columns omitted"
+    truncated = row_count > len(kept) and mode != "summary"
+    if truncated:
+        description += f", showing {'the first' if mode == 'rows' else 'a sample of'} {len(kept)} rows"
+
+    buffer = StringIO()
+    buffer.write(f"## Sheet: {sheet.title} ({description})\n")
+    if mode != "summary":
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(names)
+        for _, row in sorted(kept, key=lambda entry: entry[0]):
+            writer.writerow([format_cell(row[i]) if i < len(row) else "" for i in columns])
+    if mode == "summary" or (mode == "auto" and truncated):
+        buffer.write("Column statistics:\n")
+        for name, i in zip(names, columns):
+            buffer.write(summarize_column(name, stats[i]) + "\n")
+    return buffer.getvalue()
+
+# Function to read text from every sheet of an Excel file without loading it into memory
+def read_excel(file, max_rows=EXCEL_MAX_ROWS, mode="auto"):
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheets = [read_worksheet(sheet, max_rows, mode) for sheet in workbook.worksheets]
+    finally:
+        workbook.close()
+    return "\n".join(sheet for sheet in sheets if sheet)
+
+# Function to read text from a PowerPoint file
+def read_pptx(file):
+    presentation = Presentation(file)
+    text = ""
+    for slide in presentation.slides:
+        for shape in slide.shapes:
+            if hasattr(shape, "text"):
+                text += shape.text + "\n"
+    return text
+
+# Function to yield (page number, text, rendered PNG) for some pages of a PDF, given as bytes
+# or a file path. Pages without text are skipped, or rendered for OCR when ocr is set and the
+# page contains images.
+def iter_pdf_page_range(source, page_numbers, ocr):
+    document = fitz.open(source) if isinstance(source, str) else fitz.open(stream=source, filetype="pdf")
+    with document:
+        for page_number in page_numbers:
+            page = document.load_page(page_number)
+            text = page.get_text().strip()
+            if text:
+                yield page_number, text, None
+            elif ocr and page.get_images():
+                yield page_number, None, page.get_pixmap(dpi=PDF_OCR_DPI).tobytes("png")
+
+# Function to extract some pages of a PDF in a worker process
+def extract_pdf_pages(source, page_numbers, ocr):
+    return list(iter_pdf_page_range(source, page_numbers, ocr))
+
+# Parsers that extract_document can run, by name
+document_parsers = {
+    "read_docx": read_docx,
+    "read_excel": read_excel,
+    "read_pptx": read_pptx,
+}
+
+# Function to run a document parser on a file's content in a worker process
+def extract_document(parser_name, file_name, data, options=None):
+    file = BytesIO(data)
+    file.name = file_name
+    return document_parsers[parser_name](file, **(options or {}))